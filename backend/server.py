@@ -1,46 +1,320 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, File, UploadFile, Form
+import time
+IMPORT_STARTED = time.perf_counter()
+
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, File, UploadFile, Form, Request, Response
+from fastapi.responses import JSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers, MutableHeaders
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import DeleteOne, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, ExecutionTimeout
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional
+from pydantic import BaseModel, Field, ConfigDict, TypeAdapter
+from typing import Dict, List, Literal, Optional
 import uuid
 from datetime import datetime, timezone, timedelta
 import jwt
-from passlib.context import CryptContext
 import base64
+import hashlib
+from urllib.parse import quote
 from io import BytesIO
-from PIL import Image
-from collections import Counter
+from collections import Counter, OrderedDict
 import colorsys
-from emergentintegrations.llm.chat import LlmChat, UserMessage, ImageContent
+import asyncio
+import json
+import gzip
+from contextlib import asynccontextmanager
+from contextvars import Context, ContextVar
+from functools import lru_cache
+import importlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import numpy as np  # imported lazily, like Pillow: it is the slowest import on the boot path
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
+# ==================== QUERY PROFILER ====================
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+MAX_PROFILED_SHAPES = 500
+
+# maxTimeMS budgets for reads made while serving a route, matched by the longest
+# prefix that ends on a path segment boundary
+DEFAULT_QUERY_BUDGET_MS = 5000
+ROUTE_QUERY_BUDGETS_MS = {
+    "/api/home": 1000,
+    "/api/products": 2000,
+    "/api/products/batch": 10000,  # owner bulk operation
+    "/api/images": 2000,
+    "/api/reviews": 1000,
+    "/api/metadata": 1000,
+    "/api/feedback": 1000,
+    "/api/cart": 2000,
+    "/api/owner": 10000,
+}
+
+# Unset outside requests. Tasks inherit their creator's context, so background
+# work started from a request must go through spawn_background to run unbudgeted.
+query_budget_ms: ContextVar[Optional[int]] = ContextVar('query_budget_ms', default=None)
+query_route: ContextVar[str] = ContextVar('query_route', default='background')
+
+# Strong references to running background tasks, cancelled on shutdown
+background_tasks: set = set()
+
+def spawn_background(coro) -> asyncio.Task:
+    """Start a task in a fresh context: no request budget, slow queries attributed to 'background'"""
+    task = asyncio.create_task(coro, context=Context())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def route_query_budget(path: str) -> int:
+    matches = [prefix for prefix in ROUTE_QUERY_BUDGETS_MS if path == prefix or path.startswith(prefix + "/")]
+    return ROUTE_QUERY_BUDGETS_MS[max(matches, key=len)] if matches else DEFAULT_QUERY_BUDGET_MS
+
+def explain_command(collection_name: str, operation: str, query: dict) -> tuple:
+    """The command to explain for a profiled operation, plus a note when it is only an approximation"""
+    if operation == "count_documents":
+        # count_documents runs this aggregation
+        pipeline = [{"$match": query}, {"$group": {"_id": 1, "n": {"$sum": 1}}}]
+        return {"aggregate": collection_name, "pipeline": pipeline, "cursor": {}}, None
+    if operation in ("delete_one", "delete_many"):
+        limit = 1 if operation == "delete_one" else 0
+        return {"delete": collection_name, "deletes": [{"q": query, "limit": limit}]}, None
+    if operation in ("update_one", "update_many"):
+        # The update document is not recorded; document selection is planned like this find
+        return {"find": collection_name, "filter": query}, "find with the same filter"
+    if operation == "find_one":
+        return {"find": collection_name, "filter": query, "limit": 1}, None
+    return {"find": collection_name, "filter": query}, None
+
+def filter_shape(value):
+    """Replace literal values in a query filter with type placeholders, keeping keys and operators"""
+    if isinstance(value, dict):
+        return {k: filter_shape(v) for k, v in sorted(value.items())}
+    if isinstance(value, list):
+        if value and all(isinstance(v, dict) for v in value):
+            return [filter_shape(v) for v in value]
+        return ["<list>"]
+    return f"<{type(value).__name__}>"
+
+class QueryProfiler:
+    """Aggregates slow queries by collection, operation and filter shape"""
+    
+    def __init__(self):
+        self.shapes: Dict[str, dict] = {}
+    
+    def record(self, database, collection_name: str, operation: str, query: Optional[dict], elapsed_ms: float):
+        if elapsed_ms < SLOW_QUERY_MS:
+            return
+        shape = filter_shape(query or {})
+        key = f"{collection_name}.{operation} {json.dumps(shape, sort_keys=True)}"
+        route = query_route.get()
+        logging.warning(f"Slow query ({elapsed_ms:.0f} ms) on {route}: {key}")
+        
+        entry = self.shapes.get(key)
+        if entry is None:
+            if len(self.shapes) >= MAX_PROFILED_SHAPES:
+                return
+            entry = self.shapes[key] = {
+                "collection": collection_name,
+                "operation": operation,
+                "shape": shape,
+                "count": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "first_seen": datetime.now(timezone.utc).isoformat(),
+                "explain": None
+            }
+            # Explain only the first occurrence of each shape
+            if query is not None:
+                spawn_background(self._capture_explain(entry, database, collection_name, operation, query))
+        
+        entry["count"] += 1
+        entry["total_ms"] += elapsed_ms
+        entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+        entry["last_route"] = route
+        entry["last_seen"] = datetime.now(timezone.utc).isoformat()
+    
+    async def _capture_explain(self, entry: dict, database, collection_name: str, operation: str, query: dict):
+        try:
+            command, approximation = explain_command(collection_name, operation, query)
+            # queryPlanner verbosity plans the query without executing it again
+            result = await database.command({"explain": command, "verbosity": "queryPlanner"})
+            planner = result.get("queryPlanner")
+            if planner is None:
+                # Aggregations that are not pushed down nest the plan under their first stage
+                planner = result.get("stages", [{}])[0].get("$cursor", {}).get("queryPlanner", {})
+            explain = {
+                "command": next(iter(command)),
+                "winningPlan": planner.get("winningPlan"),
+                "rejectedPlans": len(planner.get("rejectedPlans", []))
+            }
+            if approximation:
+                explain["approximation"] = approximation
+            entry["explain"] = json.loads(json.dumps(explain, default=str))
+        except Exception as e:
+            entry["explain"] = {"error": str(e)}
+    
+    def top(self, limit: int) -> List[dict]:
+        entries = sorted(self.shapes.values(), key=lambda e: e["total_ms"], reverse=True)[:limit]
+        return [{**e, "avg_ms": e["total_ms"] / e["count"]} for e in entries]
+
+query_profiler = QueryProfiler()
+
+class ProfiledCursor:
+    """Motor cursor wrapper that applies the route budget and times result fetching"""
+    
+    def __init__(self, cursor, collection: "ProfiledCollection", query: Optional[dict]):
+        self._cursor = cursor
+        self._collection = collection
+        self._query = query
+        self._elapsed = 0.0
+        budget = query_budget_ms.get()
+        if budget:
+            cursor.max_time_ms(budget)
+    
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+    
+    def sort(self, *args, **kwargs):
+        self._cursor.sort(*args, **kwargs)
+        return self
+    
+    def limit(self, *args, **kwargs):
+        self._cursor.limit(*args, **kwargs)
+        return self
+    
+    def skip(self, *args, **kwargs):
+        self._cursor.skip(*args, **kwargs)
+        return self
+    
+    async def to_list(self, length):
+        start = time.perf_counter()
+        try:
+            return await self._cursor.to_list(length)
+        finally:
+            self._collection._record("find", self._query, start)
+    
+    def __aiter__(self):
+        return self
+    
+    async def __anext__(self):
+        start = time.perf_counter()
+        try:
+            return await self._cursor.next()
+        except StopAsyncIteration:
+            self._collection._record("find", self._query, start - self._elapsed)
+            raise
+        finally:
+            self._elapsed += time.perf_counter() - start
+
+class ProfiledCollection:
+    """Thin Motor collection wrapper: per-route maxTimeMS on reads, slow-query recording on everything"""
+    
+    def __init__(self, database, collection):
+        self._database = database
+        self._collection = collection
+    
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+    
+    def _record(self, operation: str, query: Optional[dict], start: float):
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        query_profiler.record(self._database, self._collection.name, operation, query, elapsed_ms)
+    
+    async def _timed(self, operation: str, query: Optional[dict], call):
+        start = time.perf_counter()
+        try:
+            return await call
+        finally:
+            self._record(operation, query, start)
+    
+    def find(self, filter=None, *args, **kwargs):
+        return ProfiledCursor(self._collection.find(filter, *args, **kwargs), self, filter)
+    
+    async def find_one(self, filter=None, *args, **kwargs):
+        budget = query_budget_ms.get()
+        if budget:
+            kwargs.setdefault("max_time_ms", budget)
+        return await self._timed("find_one", filter, self._collection.find_one(filter, *args, **kwargs))
+    
+    async def count_documents(self, filter, *args, **kwargs):
+        budget = query_budget_ms.get()
+        if budget:
+            kwargs.setdefault("maxTimeMS", budget)
+        return await self._timed("count_documents", filter, self._collection.count_documents(filter, *args, **kwargs))
+    
+    async def insert_one(self, document, *args, **kwargs):
+        return await self._timed("insert_one", None, self._collection.insert_one(document, *args, **kwargs))
+    
+    async def update_one(self, filter, update, *args, **kwargs):
+        return await self._timed("update_one", filter, self._collection.update_one(filter, update, *args, **kwargs))
+    
+    async def update_many(self, filter, update, *args, **kwargs):
+        return await self._timed("update_many", filter, self._collection.update_many(filter, update, *args, **kwargs))
+    
+    async def delete_one(self, filter, *args, **kwargs):
+        return await self._timed("delete_one", filter, self._collection.delete_one(filter, *args, **kwargs))
+    
+    async def delete_many(self, filter, *args, **kwargs):
+        return await self._timed("delete_many", filter, self._collection.delete_many(filter, *args, **kwargs))
+    
+    async def bulk_write(self, requests, *args, **kwargs):
+        return await self._timed("bulk_write", None, self._collection.bulk_write(requests, *args, **kwargs))
+
+class ProfiledDatabase:
+    """Exposes collections as ProfiledCollection, so `db.products` etc. go through the profiler"""
+    
+    def __init__(self, database=None):
+        self._database = database
+        self._collections: Dict[str, ProfiledCollection] = {}
+    
+    def bind(self, database):
+        """Attach the Motor database once the client exists"""
+        self._database = database
+        self._collections = {}
+    
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+    
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = ProfiledCollection(self._database, self._database[name])
+        return self._collections[name]
+
+# MongoDB connection (client is created by the lifespan handler)
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+client: Optional[AsyncIOMotorClient] = None
+db = ProfiledDatabase()
 
 # JWT Configuration
 JWT_SECRET = os.environ.get('JWT_SECRET', 'milan_readymades_secret_key_2025')
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing (passlib/bcrypt are imported on first use)
+@lru_cache(maxsize=None)
+def get_pwd_context():
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 # Security
 security = HTTPBearer()
 
-# Create the main app
-app = FastAPI()
-
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
@@ -271,8 +545,44 @@ class FeedbackSubmit(BaseModel):
     name: str
     message: str
 
+class ProductFilter(BaseModel):
+    category: Optional[str] = None
+    subcategory: Optional[str] = None
+    gender: Optional[str] = None
+    age_group: Optional[str] = None
+    is_new_arrival: Optional[bool] = None
+    show_in_fresh_arrivals: Optional[bool] = None
+
+class BatchOperation(BaseModel):
+    op: Literal["update", "delete", "add_image", "remove_image"]
+    product_id: str
+    updates: Optional[ProductUpdate] = None  # update
+    image_url: Optional[str] = None  # add_image (data URL or stored image URL), remove_image
+    is_primary: bool = False  # add_image
+
+class BatchFilterUpdate(BaseModel):
+    filter: ProductFilter
+    updates: ProductUpdate
+
+class ProductBatchRequest(BaseModel):
+    operations: List[BatchOperation] = Field(default=[], max_length=1000)
+    filter_update: Optional[BatchFilterUpdate] = None
+
+class CartEnquiryItem(BaseModel):
+    product_id: str = Field(max_length=64)
+    size: Optional[str] = Field(default=None, max_length=64)
+    color: Optional[str] = Field(default=None, max_length=64)
+    quantity: int = Field(default=1, ge=1, le=100)
+
 class CartEnquiry(BaseModel):
-    items: List[dict]
+    items: List[CartEnquiryItem] = Field(min_length=1, max_length=50)
+
+class HomeSnapshot(BaseModel):
+    fresh_arrivals: List[Product]
+    fresh_arrivals_count: int
+    new_arrivals: Dict[str, List[Product]]
+    reviews: List[Review]
+    generated_at: datetime
 
 # ==================== HELPER FUNCTIONS ====================
 
@@ -338,6 +648,7 @@ def is_background_color(rgb):
 
 async def detect_color_from_image(image_base64: str) -> dict:
     """Detect primary color from image using image processing"""
+    from PIL import Image
     color_names = [c["name"] for c in COLOR_PALETTE]
     
     try:
@@ -391,6 +702,789 @@ async def detect_color_from_image(image_base64: str) -> dict:
         logging.error(f"Color detection error: {str(e)}")
         return {"primary_color": "Unknown", "suggested_colors": color_names}
 
+# ==================== IMAGE STORE ====================
+
+# Product images are stored once in db.images and referenced by URL, so the
+# same photo uploaded to several products is not duplicated. Only identical
+# bytes are reused: dHash ignores color, so color variants of one garment
+# hash alike and are reported as near-duplicates instead.
+IMAGE_URL_PREFIX = "/api/images/"
+IMAGE_DUPLICATE_DISTANCE = 6  # visually near-identical photos
+
+def compute_dhash(image_bytes: bytes) -> int:
+    """64-bit difference hash: sign of horizontal gradients on a 9x8 grayscale thumbnail"""
+    import numpy as np
+    from PIL import Image
+    image = Image.open(BytesIO(image_bytes))
+    image.draft('L', (36, 32))
+    pixels = np.asarray(image.convert('L').resize((9, 8), Image.Resampling.LANCZOS), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+class BKTree:
+    """Burkhard-Keller tree over 64-bit image hashes for Hamming range queries"""
+    
+    def __init__(self):
+        self.root = None
+        self.size = 0
+    
+    def __len__(self):
+        return self.size
+    
+    def add(self, image_hash: int, image_id: str):
+        self.size += 1
+        if self.root is None:
+            self.root = (image_hash, [image_id], {})
+            return
+        node = self.root
+        while True:
+            node_hash, node_ids, children = node
+            distance = hamming_distance(image_hash, node_hash)
+            if distance == 0:
+                node_ids.append(image_id)
+                return
+            if distance not in children:
+                children[distance] = (image_hash, [image_id], {})
+                return
+            node = children[distance]
+    
+    def search(self, image_hash: int, threshold: int) -> List[tuple]:
+        """Return (distance, image_id) pairs within threshold, closest first"""
+        if self.root is None:
+            return []
+        matches = []
+        stack = [self.root]
+        while stack:
+            node_hash, node_ids, children = stack.pop()
+            distance = hamming_distance(image_hash, node_hash)
+            if distance <= threshold:
+                matches.extend((distance, image_id) for image_id in node_ids)
+            for child_distance, child in children.items():
+                if distance - threshold <= child_distance <= distance + threshold:
+                    stack.append(child)
+        return sorted(matches)
+    
+    def items(self):
+        """Yield (image_hash, image_id) for every indexed image"""
+        stack = [self.root] if self.root else []
+        while stack:
+            node_hash, node_ids, children = stack.pop()
+            for image_id in node_ids:
+                yield node_hash, image_id
+            stack.extend(children.values())
+
+def stored_image_url(image_id: str) -> str:
+    return f"{IMAGE_URL_PREFIX}{image_id}"
+
+async def load_image_bytes(image_url: str) -> bytes:
+    """Fetch image bytes for either a stored image URL or an inline data URL"""
+    if image_url.startswith(IMAGE_URL_PREFIX):
+        doc = await db.images.find_one({"id": image_url[len(IMAGE_URL_PREFIX):]}, {"_id": 0, "data": 1})
+        if not doc:
+            raise ValueError(f"Stored image not found: {image_url}")
+        return bytes(doc["data"])
+    return image_bytes_from_url(image_url)
+
+async def store_image(contents: bytes, content_type: str) -> dict:
+    """Store an image once, reusing the stored copy when the bytes are identical"""
+    sha256 = hashlib.sha256(contents).hexdigest()
+    existing = await db.images.find_one({"sha256": sha256}, {"_id": 0, "id": 1})
+    if existing:
+        return {"id": existing["id"], "url": stored_image_url(existing["id"]), "reused": True}
+    
+    image_hash = await asyncio.to_thread(compute_dhash, contents)
+    image_id = str(uuid.uuid4())
+    
+    # Upsert on the unique sha256 so concurrent uploads and migrations on
+    # several workers converge on a single document
+    try:
+        result = await db.images.update_one(
+            {"sha256": sha256},
+            {"$setOnInsert": {
+                "id": image_id,
+                "dhash": f"{image_hash:016x}",
+                "content_type": content_type,
+                "size": len(contents),
+                "data": contents,
+                "created_at": datetime.now(timezone.utc).isoformat()
+            }},
+            upsert=True
+        )
+        inserted = result.upserted_id is not None
+    except DuplicateKeyError:
+        inserted = False
+    
+    if not inserted:
+        existing = await db.images.find_one({"sha256": sha256}, {"_id": 0, "id": 1})
+        return {"id": existing["id"], "url": stored_image_url(existing["id"]), "reused": True}
+    
+    return {"id": image_id, "url": stored_image_url(image_id), "reused": False}
+
+async def externalize_images(images: list) -> list:
+    """Move inline data-URL images into the image store, returning the rewritten image list"""
+    externalized = []
+    for image in images:
+        url = image.get("url", "")
+        if url.startswith("data:"):
+            content_type = url[len("data:"):].split(';', 1)[0] or "image/jpeg"
+            stored = await store_image(image_bytes_from_url(url), content_type)
+            image = {**image, "url": stored["url"]}
+        externalized.append(image)
+    return externalized
+
+async def migrate_inline_images():
+    """Move legacy inline data-URL product images into the image store"""
+    try:
+        migrated = 0
+        async for product in db.products.find({"images.url": {"$regex": "^data:"}}, {"_id": 0, "id": 1, "images": 1}):
+            try:
+                images = await externalize_images(product.get("images", []))
+            except Exception as e:
+                logging.warning(f"Image migration skipped for product {product['id']}: {str(e)}")
+                continue
+            await db.products.update_one({"id": product["id"]}, {"$set": {"images": images}})
+            migrated += 1
+        
+        if migrated:
+            home_snapshot.invalidate()
+        logging.info(f"Image migration: {migrated} products migrated")
+    except Exception as e:
+        logging.error(f"Image migration error: {str(e)}")
+
+# ==================== SIMILARITY INDEX ====================
+
+# Feature vector layout: joint RGB histogram of the primary image, coarse
+# primary color bucket, fabric one-hot (last slot catches custom fabrics)
+SIMILARITY_HIST_BINS = 4
+SIMILARITY_COLOR_BINS = 3
+SIMILARITY_HIST_WEIGHT = 1.0
+SIMILARITY_COLOR_WEIGHT = 0.6
+SIMILARITY_FABRIC_WEIGHT = 0.4
+SIMILARITY_HIST_DIM = SIMILARITY_HIST_BINS ** 3
+SIMILARITY_COLOR_DIM = SIMILARITY_COLOR_BINS ** 3
+SIMILARITY_DIM = SIMILARITY_HIST_DIM + SIMILARITY_COLOR_DIM + len(FABRIC_OPTIONS) + 1
+
+PALETTE_RGB = {c["name"].lower(): hex_to_rgb(c["hex"]) for c in COLOR_PALETTE}
+FABRIC_INDEX = {name.lower(): idx for idx, name in enumerate(FABRIC_OPTIONS)}
+
+def image_bytes_from_url(image_url: str) -> bytes:
+    """Decode the base64 payload of a stored data URL"""
+    return base64.b64decode(image_url.split(',', 1)[-1])
+
+def primary_image_url(images: list) -> Optional[str]:
+    """Return the primary image URL, falling back to the first image"""
+    for image in images:
+        if image.get("is_primary"):
+            return image.get("url")
+    return images[0].get("url") if images else None
+
+def compute_color_histogram(image_bytes: bytes) -> List[float]:
+    """Compute a normalized joint RGB histogram of the non-background pixels"""
+    import numpy as np
+    from PIL import Image
+    image = Image.open(BytesIO(image_bytes))
+    image.draft('RGB', (64, 64))
+    image = image.convert('RGB')
+    image.thumbnail((64, 64))
+    
+    pixels = np.asarray(image, dtype=np.uint8).reshape(-1, 3)
+    
+    # Same background rule as is_background_color, vectorized
+    background = (pixels > 240).all(axis=1) | (pixels < 15).all(axis=1)
+    if (~background).sum() >= len(pixels) * 0.1:
+        pixels = pixels[~background]
+    
+    bins = SIMILARITY_HIST_BINS
+    quantized = (pixels // (256 // bins)).astype(np.int32)
+    codes = quantized[:, 0] * bins * bins + quantized[:, 1] * bins + quantized[:, 2]
+    histogram = np.bincount(codes, minlength=SIMILARITY_HIST_DIM).astype(np.float32)
+    histogram /= max(histogram.sum(), 1.0)
+    return histogram.tolist()
+
+async def histogram_for_images(images: list) -> List[float]:
+    """Color histogram of a product's primary image (empty if unavailable)"""
+    image_url = primary_image_url(images)
+    if not image_url:
+        return []
+    try:
+        image_bytes = await load_image_bytes(image_url)
+        return await asyncio.to_thread(compute_color_histogram, image_bytes)
+    except Exception as e:
+        logging.warning(f"Histogram computation failed: {str(e)}")
+        return []
+
+def build_feature_vector(histogram: List[float], primary_color: Optional[str], fabric: Optional[str]) -> "np.ndarray":
+    """Build the L2-normalized similarity vector for a product"""
+    import numpy as np
+    vector = np.zeros(SIMILARITY_DIM, dtype=np.float32)
+    
+    # sqrt turns the cosine of two histograms into their Bhattacharyya coefficient
+    if histogram:
+        vector[:SIMILARITY_HIST_DIM] = np.sqrt(np.asarray(histogram, dtype=np.float32)) * SIMILARITY_HIST_WEIGHT
+    
+    rgb = PALETTE_RGB.get((primary_color or "").lower())
+    if rgb:
+        bins = SIMILARITY_COLOR_BINS
+        r, g, b = (channel * bins // 256 for channel in rgb)
+        vector[SIMILARITY_HIST_DIM + r * bins * bins + g * bins + b] = SIMILARITY_COLOR_WEIGHT
+    
+    fabric_slot = FABRIC_INDEX.get((fabric or "").lower(), len(FABRIC_OPTIONS))
+    vector[SIMILARITY_HIST_DIM + SIMILARITY_COLOR_DIM + fabric_slot] = SIMILARITY_FABRIC_WEIGHT
+    
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+class SimilarityIndex:
+    """In-memory feature matrix for nearest-neighbour product lookups
+    
+    Every worker keeps its own copy. Writes persist their inputs to
+    db.product_features (deletes leave a tombstone row), and each worker pulls
+    rows changed since its updated_at watermark at most every
+    SIMILARITY_SYNC_SECONDS, so a write on one worker reaches the others.
+    """
+    
+    def __init__(self, dim: int, capacity: int = 1024):
+        self.dim = dim
+        self.capacity = capacity
+        self.matrix = None  # allocated on the first upsert so numpy is not imported at startup
+        self.ids: List[str] = []
+        self.rows: dict = {}
+        self.changed_at: Dict[str, float] = {}  # monotonic time of each product's last upsert or removal
+        self.synced_until: Optional[str] = None  # updated_at watermark of the last sync
+        self.checked_at = 0.0
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def __contains__(self, product_id: str):
+        return product_id in self.rows
+    
+    def changed_since(self, product_id: str, started: float) -> bool:
+        return self.changed_at.get(product_id, 0.0) > started
+    
+    def upsert(self, product_id: str, vector: "np.ndarray"):
+        import numpy as np
+        self.changed_at[product_id] = time.monotonic()
+        if self.matrix is None:
+            self.matrix = np.zeros((self.capacity, self.dim), dtype=np.float32)
+        row = self.rows.get(product_id)
+        if row is None:
+            row = len(self.ids)
+            if row == len(self.matrix):
+                grown = np.zeros((len(self.matrix) * 2, self.matrix.shape[1]), dtype=np.float32)
+                grown[:row] = self.matrix
+                self.matrix = grown
+            self.ids.append(product_id)
+            self.rows[product_id] = row
+        self.matrix[row] = vector
+    
+    def remove(self, product_id: str):
+        self.changed_at[product_id] = time.monotonic()
+        row = self.rows.pop(product_id, None)
+        if row is None:
+            return
+        # Move the last row into the hole to keep the matrix dense
+        last = len(self.ids) - 1
+        if row != last:
+            last_id = self.ids[last]
+            self.matrix[row] = self.matrix[last]
+            self.ids[row] = last_id
+            self.rows[last_id] = row
+        self.ids.pop()
+        self.matrix[last] = 0
+    
+    def nearest(self, product_id: str, k: int) -> List[tuple]:
+        """Return up to k (product_id, score) pairs ordered by cosine similarity"""
+        import numpy as np
+        row = self.rows.get(product_id)
+        count = len(self.ids)
+        k = min(k, count - 1)
+        if row is None or k <= 0:
+            return []
+        
+        scores = self.matrix[:count] @ self.matrix[row]
+        scores[row] = -np.inf
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[i], float(scores[i])) for i in top]
+
+similarity_index = SimilarityIndex(SIMILARITY_DIM)
+
+SIMILARITY_SYNC_SECONDS = 5
+# Rows are re-read this far behind the watermark, covering writes that committed
+# after a later timestamp was already seen and small clock differences between workers
+SIMILARITY_SYNC_OVERLAP = timedelta(seconds=30)
+
+def feature_doc_vector(feature_doc: dict) -> "np.ndarray":
+    return build_feature_vector(feature_doc.get("histogram", []), feature_doc.get("primary_color"), feature_doc.get("fabric"))
+
+async def save_product_features(feature_docs: List[dict]) -> set:
+    """Persist feature rows and return the product ids written
+    
+    Tombstoned (deleted) products are skipped: the filter excludes them, so the
+    upsert collides with the unique product_id index instead of reviving them.
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    requests = [
+        UpdateOne(
+            {"product_id": doc["product_id"], "deleted": {"$ne": True}},
+            {"$set": {**doc, "updated_at": now}},
+            upsert=True
+        )
+        for doc in feature_docs
+    ]
+    saved = {doc["product_id"] for doc in feature_docs}
+    if not requests:
+        return saved
+    try:
+        await db.product_features.bulk_write(requests, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details.get("writeErrors", []):
+            if error.get("code") != 11000:
+                raise
+            saved.discard(feature_docs[error["index"]]["product_id"])
+    return saved
+
+async def refresh_product_features(product: dict, recompute_histogram: bool = True):
+    """Update a product's row in the similarity index, recomputing the image histogram if needed"""
+    histogram = None
+    if not recompute_histogram:
+        feature_doc = await db.product_features.find_one({"product_id": product["id"]}, {"_id": 0, "histogram": 1})
+        if feature_doc:
+            histogram = feature_doc.get("histogram", [])
+    
+    if histogram is None:
+        histogram = await histogram_for_images(product.get("images", []))
+    
+    feature_doc = {
+        "product_id": product["id"],
+        "histogram": histogram,
+        "primary_color": product.get("primary_color"),
+        "fabric": product.get("fabric")
+    }
+    if await save_product_features([feature_doc]):
+        similarity_index.upsert(product["id"], feature_doc_vector(feature_doc))
+
+async def remove_product_features(product_id: str):
+    """Drop a deleted product from the similarity index"""
+    await remove_many_product_features({product_id})
+
+# Concurrent image decodes when recomputing histograms for many products
+HISTOGRAM_CONCURRENCY = 4
+
+async def recompute_many_product_features(product_ids: List[str]):
+    """Recompute histograms for many products, decoding a few images at a time"""
+    try:
+        products = await db.products.find(
+            {"id": {"$in": product_ids}},
+            {"_id": 0, "id": 1, "images": 1, "primary_color": 1, "fabric": 1}
+        ).to_list(None)
+        semaphore = asyncio.Semaphore(HISTOGRAM_CONCURRENCY)
+        
+        async def feature_doc(product: dict) -> dict:
+            async with semaphore:
+                histogram = await histogram_for_images(product.get("images", []))
+            return {
+                "product_id": product["id"],
+                "histogram": histogram,
+                "primary_color": product.get("primary_color"),
+                "fabric": product.get("fabric")
+            }
+        
+        feature_docs = await asyncio.gather(*(feature_doc(product) for product in products))
+        saved = await save_product_features(feature_docs)
+        for doc in feature_docs:
+            if doc["product_id"] in saved:
+                similarity_index.upsert(doc["product_id"], feature_doc_vector(doc))
+        logging.info(f"Histograms recomputed for {len(feature_docs)} products")
+    except Exception as e:
+        logging.error(f"Histogram recompute error: {str(e)}")
+
+async def refresh_many_product_features(product_ids: set, recompute_ids: set):
+    """Batch form of refresh_product_features: one products query and one histogram query
+    
+    Products whose images changed are recomputed in the background, so their
+    rows keep the previous vector for the few seconds the decodes take.
+    """
+    if not product_ids:
+        return
+    products = await db.products.find(
+        {"id": {"$in": list(product_ids)}},
+        {"_id": 0, "id": 1, "images": 1, "primary_color": 1, "fabric": 1}
+    ).to_list(None)
+    
+    reuse_ids = [p["id"] for p in products if p["id"] not in recompute_ids]
+    feature_docs = await db.product_features.find(
+        {"product_id": {"$in": reuse_ids}}, {"_id": 0, "product_id": 1, "histogram": 1}
+    ).to_list(None)
+    histograms = {doc["product_id"]: doc.get("histogram", []) for doc in feature_docs}
+    
+    reused = []
+    recompute = []
+    for product in products:
+        if product["id"] in histograms:
+            reused.append({
+                "product_id": product["id"],
+                "histogram": histograms[product["id"]],
+                "primary_color": product.get("primary_color"),
+                "fabric": product.get("fabric")
+            })
+        else:
+            recompute.append(product["id"])
+    if recompute:
+        spawn_background(recompute_many_product_features(recompute))
+    
+    saved = await save_product_features(reused)
+    for feature_doc in reused:
+        if feature_doc["product_id"] in saved:
+            similarity_index.upsert(feature_doc["product_id"], feature_doc_vector(feature_doc))
+
+async def remove_many_product_features(product_ids: set):
+    """Batch form of remove_product_features: tombstones the feature rows so other workers drop them too"""
+    if not product_ids:
+        return
+    for product_id in product_ids:
+        similarity_index.remove(product_id)
+    now = datetime.now(timezone.utc).isoformat()
+    await db.product_features.bulk_write(
+        [
+            UpdateOne({"product_id": product_id}, {"$set": {"deleted": True, "histogram": [], "updated_at": now}}, upsert=True)
+            for product_id in product_ids
+        ],
+        ordered=False
+    )
+
+async def sync_similarity_index():
+    """Apply feature rows written by other workers since the last sync, at most every SIMILARITY_SYNC_SECONDS"""
+    if similarity_index.synced_until is None:
+        return  # not loaded yet
+    if time.monotonic() - similarity_index.checked_at < SIMILARITY_SYNC_SECONDS:
+        return
+    similarity_index.checked_at = time.monotonic()
+    since = datetime.fromisoformat(similarity_index.synced_until) - SIMILARITY_SYNC_OVERLAP
+    started = time.monotonic()
+    synced_until = datetime.now(timezone.utc).isoformat()
+    changed = await db.product_features.find(
+        {"updated_at": {"$gt": since.isoformat()}},
+        {"_id": 0, "product_id": 1, "histogram": 1, "primary_color": 1, "fabric": 1, "deleted": 1}
+    ).to_list(None)
+    for feature_doc in changed:
+        if similarity_index.changed_since(feature_doc["product_id"], started):
+            continue  # a local write landed while the query ran
+        if feature_doc.get("deleted"):
+            similarity_index.remove(feature_doc["product_id"])
+        else:
+            similarity_index.upsert(feature_doc["product_id"], feature_doc_vector(feature_doc))
+    similarity_index.synced_until = synced_until
+
+async def load_similarity_index():
+    """Build the similarity index from stored histograms, computing any that are missing
+    
+    Products changed by a live write or sync while the load runs are skipped,
+    since the load read them earlier and would overwrite the newer vector.
+    """
+    try:
+        # Import numpy off the event loop; every later import is a cache hit
+        await asyncio.to_thread(importlib.import_module, "numpy")
+        
+        started = time.monotonic()
+        similarity_index.synced_until = datetime.now(timezone.utc).isoformat()
+        
+        histograms = {}
+        async for doc in db.product_features.find({"deleted": {"$ne": True}}, {"_id": 0, "product_id": 1, "histogram": 1}):
+            histograms[doc["product_id"]] = doc.get("histogram", [])
+        
+        missing = []
+        async for product in db.products.find({}, {"_id": 0, "id": 1, "primary_color": 1, "fabric": 1}):
+            if similarity_index.changed_since(product["id"], started):
+                continue
+            if product["id"] in histograms:
+                similarity_index.upsert(
+                    product["id"],
+                    build_feature_vector(histograms[product["id"]], product.get("primary_color"), product.get("fabric"))
+                )
+            else:
+                missing.append(product["id"])
+        
+        # Products created before the index existed need their images decoded once
+        for product_id in missing:
+            if similarity_index.changed_since(product_id, started):
+                continue
+            product = await db.products.find_one(
+                {"id": product_id},
+                {"_id": 0, "id": 1, "images": 1, "primary_color": 1, "fabric": 1}
+            )
+            if product:
+                await refresh_product_features(product)
+        
+        logging.info(f"Similarity index loaded: {len(similarity_index)} products ({len(missing)} computed)")
+    except Exception as e:
+        logging.error(f"Similarity index load error: {str(e)}")
+
+# ==================== HOMEPAGE SNAPSHOT ====================
+
+HOME_CATEGORIES = ["men", "women", "kids", "accessories"]
+HOME_FRESH_ARRIVALS_LIMIT = 8
+HOME_NEW_ARRIVALS_PER_CATEGORY = 8
+HOME_REVIEWS_LIMIT = 12
+HOME_SNAPSHOT_CHECK_SECONDS = 5
+
+class HomeSnapshotCache:
+    """Serialized homepage payload, rebuilt in the background after product or review writes
+    
+    Writes bump a version stamp in db.cache_versions; every worker compares its
+    snapshot against that stamp at most every HOME_SNAPSHOT_CHECK_SECONDS, so a
+    write on one worker reaches the others. All rebuilds run through one task,
+    so an older build can never overwrite a newer one.
+    """
+    
+    def __init__(self):
+        self.body: Optional[bytes] = None
+        self.version: Optional[int] = None  # shared version the body was built from
+        self._checked_at = 0.0
+        self._dirty = False
+        self._bump = False
+        self._task: Optional[asyncio.Task] = None
+    
+    def invalidate(self):
+        """Record a write on this worker: bump the shared version and rebuild"""
+        self._bump = True
+        self.refresh()
+    
+    def refresh(self) -> asyncio.Task:
+        """Schedule a rebuild; requests arriving during a rebuild coalesce into one more pass"""
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = spawn_background(self._rebuild_loop())
+        return self._task
+    
+    async def _rebuild_loop(self):
+        while self._dirty:
+            self._dirty = False
+            try:
+                if self._bump:
+                    self._bump = False
+                    await db.cache_versions.update_one({"_id": "home"}, {"$inc": {"version": 1}}, upsert=True)
+                await self._rebuild()
+            except Exception as e:
+                logging.error(f"Homepage snapshot rebuild error: {str(e)}")
+    
+    async def _shared_version(self) -> int:
+        doc = await db.cache_versions.find_one({"_id": "home"}, {"_id": 0, "version": 1})
+        return doc["version"] if doc else 0
+    
+    async def _rebuild(self):
+        version = await self._shared_version()
+        
+        fresh_query = {"show_in_fresh_arrivals": True}
+        fresh_arrivals = await db.products.find(fresh_query, {"_id": 0}).sort("created_at", -1).to_list(HOME_FRESH_ARRIVALS_LIMIT)
+        fresh_arrivals_count = await db.products.count_documents(fresh_query)
+        
+        new_arrivals = {}
+        for category in HOME_CATEGORIES:
+            new_arrivals[category] = await db.products.find(
+                {"category": category, "is_new_arrival": True}, {"_id": 0}
+            ).sort("created_at", -1).to_list(HOME_NEW_ARRIVALS_PER_CATEGORY)
+        
+        reviews = await db.reviews.find({}, {"_id": 0}).sort("_id", -1).to_list(HOME_REVIEWS_LIMIT)
+        
+        snapshot = HomeSnapshot(
+            fresh_arrivals=fresh_arrivals,
+            fresh_arrivals_count=fresh_arrivals_count,
+            new_arrivals=new_arrivals,
+            reviews=reviews,
+            generated_at=datetime.now(timezone.utc)
+        )
+        self.body = snapshot.model_dump_json().encode('utf-8')
+        self.version = version
+        self._checked_at = time.monotonic()
+    
+    async def get(self) -> Optional[bytes]:
+        if self.body is None:
+            await asyncio.shield(self.refresh())
+        elif time.monotonic() - self._checked_at > HOME_SNAPSHOT_CHECK_SECONDS:
+            # Serve the current body while a stale snapshot rebuilds in the background
+            self._checked_at = time.monotonic()
+            if await self._shared_version() != self.version:
+                self.refresh()
+        return self.body
+
+home_snapshot = HomeSnapshotCache()
+
+# ==================== ANALYTICS ROLLUPS ====================
+
+# Enquiry and feedback counters are maintained with $inc as documents are
+# written, so analytics reads never aggregate the raw collections.
+#   db.enquiry_rollups: one doc per (day, product, size, color)
+#   db.daily_rollups:   one doc per day with enquiry, item and feedback totals
+
+def enquiry_item_key(item: dict) -> tuple:
+    """(product_id, size, color) rollup key of an enquiry item
+    
+    Older enquiries stored the client's product dict (id, selectedSize, selectedColor).
+    """
+    return (
+        str(item.get('product_id') or item.get('id') or 'unknown'),
+        str(item.get('size') or item.get('selectedSize') or 'N/A'),
+        str(item.get('color') or item.get('selectedColor') or 'N/A')
+    )
+
+def enquiry_item_quantity(item: dict) -> int:
+    """Quantity of an enquiry item; legacy items with a missing or malformed quantity count once"""
+    try:
+        return max(int(item.get("quantity") or 1), 1)
+    except (TypeError, ValueError):
+        return 1
+
+async def apply_enquiry_rollups(enquiries: List[dict]):
+    """Increment rollup counters for a batch of enquiry documents"""
+    item_counts = Counter()
+    product_names = {}
+    daily_enquiries = Counter()
+    daily_items = Counter()
+    
+    for enquiry in enquiries:
+        day = enquiry["created_at"][:10]
+        daily_enquiries[day] += 1
+        for item in enquiry.get("items") or []:
+            if not isinstance(item, dict):
+                continue  # malformed legacy item
+            product_id, size, color = enquiry_item_key(item)
+            quantity = enquiry_item_quantity(item)
+            item_counts[(day, product_id, size, color)] += quantity
+            daily_items[day] += quantity
+            if item.get("name"):
+                product_names[product_id] = item["name"]
+    
+    rollup_ops = []
+    for (day, product_id, size, color), count in item_counts.items():
+        update = {
+            "$inc": {"count": count},
+            "$setOnInsert": {"day": day, "product_id": product_id, "size": size, "color": color}
+        }
+        if product_id in product_names:
+            update["$set"] = {"product_name": product_names[product_id]}
+        rollup_ops.append(UpdateOne({"_id": f"{day}|{product_id}|{size}|{color}"}, update, upsert=True))
+    
+    daily_ops = [
+        UpdateOne({"_id": day}, {"$inc": {"enquiries": count, "enquiry_items": daily_items[day]}}, upsert=True)
+        for day, count in daily_enquiries.items()
+    ]
+    
+    if rollup_ops:
+        await db.enquiry_rollups.bulk_write(rollup_ops, ordered=False)
+    if daily_ops:
+        await db.daily_rollups.bulk_write(daily_ops, ordered=False)
+
+async def apply_feedback_rollups(feedbacks: List[dict]):
+    """Increment daily feedback counters for a batch of feedback documents"""
+    daily_feedbacks = Counter(feedback["created_at"][:10] for feedback in feedbacks)
+    if daily_feedbacks:
+        await db.daily_rollups.bulk_write(
+            [UpdateOne({"_id": day}, {"$inc": {"feedbacks": count}}, upsert=True) for day, count in daily_feedbacks.items()],
+            ordered=False
+        )
+
+# Each document is counted by whoever holds its rollup_claim and is marked
+# rolled_up only after its counters are applied. Claims older than the
+# timeout are assumed to belong to a crashed worker and may be taken over.
+ROLLUP_CLAIM_TIMEOUT = timedelta(minutes=10)
+
+def new_rollup_claim() -> dict:
+    """Fields for a freshly inserted document, claimed by the inserting request"""
+    return {
+        "rolled_up": False,
+        "rollup_claim": str(uuid.uuid4()),
+        "rollup_claimed_at": datetime.now(timezone.utc).isoformat()
+    }
+
+async def roll_up_inserted(collection, doc: dict, apply_rollups, rollup_view: Optional[dict] = None):
+    """Apply rollups for a document inserted with new_rollup_claim(), then mark it rolled up
+    
+    On failure the claim is released so the backfill counts the document later.
+    """
+    claimed = {"id": doc["id"], "rollup_claim": doc["rollup_claim"]}
+    try:
+        await apply_rollups([rollup_view or doc])
+    except Exception as e:
+        logging.error(f"Rollup error for {collection.name} {doc['id']}: {str(e)}")
+        try:
+            await collection.update_one(claimed, {"$unset": {"rollup_claim": "", "rollup_claimed_at": ""}})
+        except Exception as e:
+            logging.error(f"Rollup claim release error for {collection.name} {doc['id']}: {str(e)}")
+        return
+    
+    try:
+        await collection.update_one(
+            claimed,
+            {"$set": {"rolled_up": True}, "$unset": {"rollup_claim": "", "rollup_claimed_at": ""}}
+        )
+    except Exception as e:
+        logging.error(f"Rollup mark error for {collection.name} {doc['id']}: {str(e)}")
+
+async def claim_rollup_batch(collection, projection: dict, batch_size: int) -> Optional[List[dict]]:
+    """Atomically claim up to batch_size unrolled documents
+    
+    Returns the documents this call won (possibly none, if another worker was faster),
+    or None once nothing is left to claim.
+    """
+    now = datetime.now(timezone.utc)
+    claimable = {
+        "rolled_up": {"$ne": True},
+        "$or": [
+            {"rollup_claimed_at": None},
+            {"rollup_claimed_at": {"$lt": (now - ROLLUP_CLAIM_TIMEOUT).isoformat()}}
+        ]
+    }
+    candidates = await collection.find(claimable, {"_id": 0, "id": 1}).to_list(batch_size)
+    if not candidates:
+        return None
+    
+    claim = str(uuid.uuid4())
+    await collection.update_many(
+        {**claimable, "id": {"$in": [doc["id"] for doc in candidates]}},
+        {"$set": {"rollup_claim": claim, "rollup_claimed_at": now.isoformat()}}
+    )
+    return await collection.find({"rollup_claim": claim}, projection).to_list(None)
+
+async def backfill_analytics_rollups(batch_size: int = 500):
+    """Roll up enquiries and feedbacks that are not rolled up yet (older ones, or failed live rollups)
+    
+    Safe to run on several workers at once: batches are claimed before their counters are applied.
+    """
+    enquiry_projection = {
+        "_id": 0, "id": 1, "created_at": 1, "rollup_claim": 1,
+        "items.product_id": 1, "items.size": 1, "items.color": 1, "items.quantity": 1,
+        "items.id": 1, "items.name": 1, "items.selectedSize": 1, "items.selectedColor": 1
+    }
+    sources = [
+        (db.enquiries, enquiry_projection, apply_enquiry_rollups),
+        (db.feedbacks, {"_id": 0, "id": 1, "created_at": 1, "rollup_claim": 1}, apply_feedback_rollups),
+    ]
+    try:
+        for collection, projection, apply_rollups in sources:
+            processed = 0
+            while True:
+                batch = await claim_rollup_batch(collection, projection, batch_size)
+                if batch is None:
+                    break
+                if not batch:
+                    continue
+                await apply_rollups(batch)
+                await collection.update_many(
+                    {"rollup_claim": batch[0]["rollup_claim"]},
+                    {"$set": {"rolled_up": True}, "$unset": {"rollup_claim": "", "rollup_claimed_at": ""}}
+                )
+                processed += len(batch)
+            logging.info(f"Analytics backfill: {processed} {collection.name} rolled up")
+    except Exception as e:
+        logging.error(f"Analytics backfill error: {str(e)}")
+
+analytics_backfill_task: Optional[asyncio.Task] = None
+
 # ==================== AUTHENTICATION ROUTES ====================
 
 @api_router.post("/owner/login", response_model=OwnerResponse)
@@ -452,6 +1546,7 @@ async def get_product(product_id: str):
 async def create_product(product: ProductCreate, username: str = Depends(verify_token)):
     """Create a new product (Owner only)"""
     product_dict = product.model_dump()
+    product_dict['images'] = await externalize_images(product_dict.get('images', []))
     product_obj = Product(**product_dict)
     
     doc = product_obj.model_dump()
@@ -459,6 +1554,8 @@ async def create_product(product: ProductCreate, username: str = Depends(verify_
     doc['updated_at'] = doc['updated_at'].isoformat()
     
     await db.products.insert_one(doc)
+    await refresh_product_features(doc)
+    home_snapshot.invalidate()
     return product_obj
 
 @api_router.put("/products/{product_id}", response_model=Product)
@@ -470,10 +1567,14 @@ async def update_product(product_id: str, updates: ProductUpdate, username: str
     
     update_data = {k: v for k, v in updates.model_dump().items() if v is not None}
     update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
+    if "images" in update_data:
+        update_data["images"] = await externalize_images(update_data["images"])
     
     await db.products.update_one({"id": product_id}, {"$set": update_data})
     
     updated_product = await db.products.find_one({"id": product_id}, {"_id": 0})
+    await refresh_product_features(updated_product, recompute_histogram=updates.images is not None)
+    home_snapshot.invalidate()
     return updated_product
 
 @api_router.delete("/products/{product_id}")
@@ -482,8 +1583,187 @@ async def delete_product(product_id: str, username: str = Depends(verify_token))
     result = await db.products.delete_one({"id": product_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    await remove_product_features(product_id)
+    home_snapshot.invalidate()
     return {"message": "Product deleted successfully"}
 
+# Update fields that change a product's similarity vector
+SIMILARITY_FIELDS = {"primary_color", "fabric", "images"}
+
+async def batch_write_request(operation: BatchOperation, now: str):
+    """Translate a batch operation into a pymongo write model; raises ValueError if invalid"""
+    query = {"id": operation.product_id}
+    if operation.op == "delete":
+        return DeleteOne(query)
+    
+    if operation.op == "update":
+        if operation.updates is None:
+            raise ValueError("updates is required for update")
+        update_data = operation.updates.model_dump(exclude_none=True)
+        if "images" in update_data:
+            update_data["images"] = await externalize_images(update_data["images"])
+        update_data["updated_at"] = now
+        return UpdateOne(query, {"$set": update_data})
+    
+    if not operation.image_url:
+        raise ValueError(f"image_url is required for {operation.op}")
+    
+    if operation.op == "add_image":
+        if not operation.image_url.startswith(("data:", IMAGE_URL_PREFIX)):
+            raise ValueError("image_url must be a data URL or a stored image URL")
+        [image] = await externalize_images([{"url": operation.image_url, "is_primary": operation.is_primary}])
+        return UpdateOne(query, {"$push": {"images": image}, "$set": {"updated_at": now}})
+    
+    return UpdateOne(query, {"$pull": {"images": {"url": operation.image_url}}, "$set": {"updated_at": now}})
+
+@api_router.post("/products/batch")
+async def batch_products(batch: ProductBatchRequest, username: str = Depends(verify_token)):
+    """Apply many product updates, deletes and image changes as one unordered bulk write (Owner only)
+    
+    Operations in a batch are not ordered relative to each other, so each product may appear in at
+    most one of them; repeats, and products also matched by filter_update, are rejected as invalid.
+    A status of "ok" means the change was checked against the stored product after the write.
+    """
+    if not batch.operations and batch.filter_update is None:
+        raise HTTPException(status_code=400, detail="No operations given")
+    
+    filter_query = {}
+    filter_ids = []
+    if batch.filter_update is not None:
+        filter_query = batch.filter_update.filter.model_dump(exclude_none=True)
+        if not filter_query:
+            raise HTTPException(status_code=400, detail="filter_update.filter must set at least one field")
+        # Ids are read before the write, since the update may stop them matching the filter
+        matched = await db.products.find(filter_query, {"_id": 0, "id": 1}).to_list(None)
+        filter_ids = [p["id"] for p in matched]
+    
+    now = datetime.now(timezone.utc).isoformat()
+    
+    product_ids = list({operation.product_id for operation in batch.operations})
+    existing = await db.products.find({"id": {"$in": product_ids}}, {"_id": 0, "id": 1, "images.url": 1}).to_list(None)
+    existing_images = {p["id"]: {image.get("url") for image in p.get("images", [])} for p in existing}
+    id_counts = Counter(operation.product_id for operation in batch.operations)
+    filter_id_set = set(filter_ids)
+    
+    results = []
+    requests = []
+    request_results = []  # result dict for each entry in requests
+    for index, operation in enumerate(batch.operations):
+        result = {"index": index, "op": operation.op, "product_id": operation.product_id, "status": "ok"}
+        results.append(result)
+        if id_counts[operation.product_id] > 1:
+            result["status"] = "invalid"
+            result["error"] = "product_id appears in more than one operation"
+            continue
+        if operation.product_id in filter_id_set:
+            result["status"] = "invalid"
+            result["error"] = "product is also matched by filter_update"
+            continue
+        if operation.product_id not in existing_images:
+            result["status"] = "not_found"
+            continue
+        if operation.op == "remove_image" and operation.image_url and operation.image_url not in existing_images[operation.product_id]:
+            result["status"] = "not_found"
+            result["error"] = "image_url is not on this product"
+            continue
+        try:
+            requests.append(await batch_write_request(operation, now))
+            request_results.append(result)
+        except Exception as e:
+            result["status"] = "invalid"
+            result["error"] = str(e)
+    
+    filter_result = None
+    filter_update_data = {}
+    if batch.filter_update is not None:
+        filter_update_data = batch.filter_update.updates.model_dump(exclude_none=True)
+        if "images" in filter_update_data:
+            filter_update_data["images"] = await externalize_images(filter_update_data["images"])
+        filter_update_data["updated_at"] = now
+        filter_result = {"matched": len(filter_ids), "status": "ok"}
+        requests.append(UpdateMany(filter_query, {"$set": filter_update_data}))
+        request_results.append(filter_result)
+    
+    if requests:
+        try:
+            write_result = await db.products.bulk_write(requests, ordered=False)
+            if filter_result:
+                filter_result["modified"] = write_result.modified_count
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                failed = request_results[error["index"]]
+                failed["status"] = "error"
+                failed["error"] = error.get("errmsg", "Write failed")
+    
+    # Bulk counts are batch-wide, so check each written product to catch writes that matched nothing
+    written = [result for result in request_results if result is not filter_result and result["status"] == "ok"]
+    if written:
+        stored = await db.products.find(
+            {"id": {"$in": [result["product_id"] for result in written]}},
+            {"_id": 0, "id": 1, "images.url": 1}
+        ).to_list(None)
+        stored_images = {p["id"]: {image.get("url") for image in p.get("images", [])} for p in stored}
+        for result in written:
+            operation = batch.operations[result["index"]]
+            images = stored_images.get(operation.product_id)
+            if operation.op == "delete":
+                if images is not None:
+                    result["status"] = "error"
+                    result["error"] = "Product was not deleted"
+            elif images is None:
+                result["status"] = "not_found"
+            elif operation.op == "remove_image" and operation.image_url in images:
+                result["status"] = "error"
+                result["error"] = "Image was not removed"
+    
+    # Keep the similarity index in step with what was written
+    deleted_ids = set()
+    changed_ids = set()
+    recompute_ids = set()
+    for operation, result in zip(batch.operations, results):
+        if result["status"] != "ok":
+            continue
+        if operation.op == "delete":
+            deleted_ids.add(operation.product_id)
+        elif operation.op in ("add_image", "remove_image") or (operation.updates and operation.updates.images is not None):
+            changed_ids.add(operation.product_id)
+            recompute_ids.add(operation.product_id)
+        elif operation.updates and SIMILARITY_FIELDS & operation.updates.model_dump(exclude_none=True).keys():
+            changed_ids.add(operation.product_id)
+    if filter_result and filter_result["status"] == "ok" and SIMILARITY_FIELDS & filter_update_data.keys():
+        changed_ids.update(filter_ids)
+        if "images" in filter_update_data:
+            recompute_ids.update(filter_ids)
+    
+    await remove_many_product_features(deleted_ids)
+    await refresh_many_product_features(changed_ids - deleted_ids, recompute_ids)
+    home_snapshot.invalidate()
+    
+    return {
+        "results": results,
+        "filter_update": filter_result,
+        "summary": dict(Counter(result["status"] for result in results))
+    }
+
+@api_router.get("/products/{product_id}/similar", response_model=List[Product])
+async def get_similar_products(product_id: str, limit: int = 8):
+    """Get products that look like the given product (color histogram, primary color, fabric)"""
+    await sync_similarity_index()
+    
+    if product_id not in similarity_index:
+        product = await db.products.find_one({"id": product_id}, {"_id": 0})
+        if not product:
+            raise HTTPException(status_code=404, detail="Product not found")
+        # Reuse the stored histogram; it is only recomputed when images change
+        await refresh_product_features(product, recompute_histogram=False)
+    
+    neighbours = similarity_index.nearest(product_id, max(1, min(limit, 50)))
+    similar_ids = [similar_id for similar_id, _ in neighbours]
+    
+    products = await db.products.find({"id": {"$in": similar_ids}}, {"_id": 0}).to_list(len(similar_ids))
+    products_by_id = {p["id"]: p for p in products}
+    return [products_by_id[similar_id] for similar_id in similar_ids if similar_id in products_by_id]
+
 # ==================== IMAGE UPLOAD ROUTES ====================
 
 @api_router.post("/upload-image")
@@ -498,6 +1778,7 @@ async def upload_image(file: UploadFile = File(...), username: str = Depends(ver
         
         # Optionally resize image if too large
         try:
+            from PIL import Image
             img = Image.open(BytesIO(contents))
             if img.width > 1024 or img.height > 1024:
                 img.thumbnail((1024, 1024))
@@ -531,6 +1812,8 @@ async def transform_color(
 ):
     """Transform image to show different color using AI"""
     try:
+        from emergentintegrations.llm.chat import LlmChat, UserMessage, ImageContent
+        
         chat = LlmChat(
             api_key=EMERGENT_LLM_KEY,
             session_id=f"color-transform-{uuid.uuid4()}",
@@ -570,25 +1853,30 @@ async def add_product_image(
     is_primary: bool = Form(False),
     username: str = Depends(verify_token)
 ):
-    """Add an image to a product"""
-    # Upload image first
-    contents = await file.read()
-    image_base64 = base64.b64encode(contents).decode('utf-8')
-    image_url = f"data:image/{file.content_type.split('/')[-1]};base64,{image_base64}"
-    
-    # Add to product
+    """Add an image to a product, reusing an already stored copy of identical bytes"""
     product = await db.products.find_one({"id": product_id}, {"_id": 0})
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    new_image = {"url": image_url, "is_primary": is_primary}
+    contents = await file.read()
+    try:
+        stored = await store_image(contents, file.content_type or "image/jpeg")
+    except Exception as e:
+        logging.error(f"Image store error: {str(e)}")
+        raise HTTPException(status_code=400, detail="Invalid image file")
+    
+    new_image = {"url": stored["url"], "is_primary": is_primary}
     
     await db.products.update_one(
         {"id": product_id},
         {"$push": {"images": new_image}, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
     )
     
-    return {"message": "Image added successfully", "image": new_image}
+    product["images"] = product.get("images", []) + [new_image]
+    await refresh_product_features(product)
+    home_snapshot.invalidate()
+    
+    return {"message": "Image added successfully", "image": new_image, "reused": stored["reused"]}
 
 @api_router.delete("/products/{product_id}/remove-image")
 async def remove_product_image(product_id: str, image_url: str = Form(...), username: str = Depends(verify_token)):
@@ -601,8 +1889,75 @@ async def remove_product_image(product_id: str, image_url: str = Form(...), user
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Product or image not found")
     
+    product = await db.products.find_one({"id": product_id}, {"_id": 0})
+    if product:
+        await refresh_product_features(product)
+    home_snapshot.invalidate()
+    
     return {"message": "Image removed successfully"}
 
+@api_router.get("/images/duplicates")
+async def find_duplicate_images(threshold: int = IMAGE_DUPLICATE_DISTANCE, username: str = Depends(verify_token)):
+    """Group stored images whose perceptual hashes are within a Hamming threshold (Owner only)"""
+    threshold = max(0, min(threshold, 32))
+    
+    # Built from db.images on each call so uploads handled by any worker are included
+    image_hash_index = BKTree()
+    async for doc in db.images.find({}, {"_id": 0, "id": 1, "dhash": 1}):
+        image_hash_index.add(int(doc["dhash"], 16), doc["id"])
+    
+    # Union-find over BK-tree range queries
+    parent = {}
+    
+    def find(image_id):
+        while parent.setdefault(image_id, image_id) != image_id:
+            parent[image_id] = parent[parent[image_id]]
+            image_id = parent[image_id]
+        return image_id
+    
+    for image_hash, image_id in image_hash_index.items():
+        for _, match_id in image_hash_index.search(image_hash, threshold):
+            parent[find(match_id)] = find(image_id)
+    
+    groups = {}
+    for image_id in parent:
+        groups.setdefault(find(image_id), []).append(image_id)
+    groups = [ids for ids in groups.values() if len(ids) > 1]
+    
+    duplicate_urls = [stored_image_url(image_id) for ids in groups for image_id in ids]
+    products = await db.products.find(
+        {"images.url": {"$in": duplicate_urls}},
+        {"_id": 0, "id": 1, "name": 1, "images.url": 1}
+    ).to_list(None)
+    products_by_url = {}
+    for product in products:
+        for image in product.get("images", []):
+            products_by_url.setdefault(image["url"], []).append({"id": product["id"], "name": product["name"]})
+    
+    return {
+        "threshold": threshold,
+        "groups": [
+            [
+                {"id": image_id, "url": stored_image_url(image_id), "products": products_by_url.get(stored_image_url(image_id), [])}
+                for image_id in ids
+            ]
+            for ids in groups
+        ]
+    }
+
+@api_router.get("/images/{image_id}")
+async def get_image(image_id: str):
+    """Serve a stored product image"""
+    doc = await db.images.find_one({"id": image_id}, {"_id": 0, "data": 1, "content_type": 1})
+    if not doc:
+        raise HTTPException(status_code=404, detail="Image not found")
+    # Image ids never change content, so browsers may cache them indefinitely
+    return Response(
+        content=bytes(doc["data"]),
+        media_type=doc.get("content_type", "image/jpeg"),
+        headers={"Cache-Control": "public, max-age=31536000, immutable"}
+    )
+
 # ==================== REVIEW ROUTES ====================
 
 @api_router.get("/reviews", response_model=List[Review])
@@ -619,6 +1974,7 @@ async def create_review(review: ReviewCreate, username: str = Depends(verify_tok
     
     doc = review_obj.model_dump()
     await db.reviews.insert_one(doc)
+    home_snapshot.invalidate()
     return review_obj
 
 @api_router.put("/reviews/{review_id}", response_model=Review)
@@ -633,6 +1989,7 @@ async def update_review(review_id: str, updates: ReviewUpdate, username: str = D
     await db.reviews.update_one({"id": review_id}, {"$set": update_data})
     
     updated_review = await db.reviews.find_one({"id": review_id}, {"_id": 0})
+    home_snapshot.invalidate()
     return updated_review
 
 @api_router.delete("/reviews/{review_id}")
@@ -641,6 +1998,7 @@ async def delete_review(review_id: str, username: str = Depends(verify_token)):
     result = await db.reviews.delete_one({"id": review_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Review not found")
+    home_snapshot.invalidate()
     return {"message": "Review deleted successfully"}
 
 @api_router.post("/reviews/public")
@@ -656,6 +2014,7 @@ async def create_public_review(review: PublicReviewCreate):
     
     doc = review_obj.model_dump()
     await db.reviews.insert_one(doc)
+    home_snapshot.invalidate()
     return {"message": "Thank you for your feedback! Your review has been submitted.", "review": review_obj}
 
 # ==================== FEEDBACK & WHATSAPP ROUTES ====================
@@ -674,9 +2033,11 @@ async def submit_feedback(feedback: FeedbackSubmit):
             "id": str(uuid.uuid4()),
             "name": feedback.name,
             "message": feedback.message,
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            **new_rollup_claim()
         }
         await db.feedbacks.insert_one(feedback_doc)
+        await roll_up_inserted(db.feedbacks, feedback_doc, apply_feedback_rollups)
         
         return {
             "message": "Your feedback is valuable. Thank you for your time.",
@@ -686,46 +2047,158 @@ async def submit_feedback(feedback: FeedbackSubmit):
         logging.error(f"Feedback submission error: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to submit feedback")
 
+def catalog_option(value: Optional[str], options: List[str], label: str, product: dict) -> Optional[str]:
+    """Match a client-chosen size or color against the product's options, case-insensitively"""
+    if not value:
+        return None
+    for option in options:
+        if option.strip().lower() == value.strip().lower():
+            return option
+    raise HTTPException(
+        status_code=400,
+        detail=f"{label} '{value}' is not available for {product.get('name', product['id'])}"
+    )
+
 @api_router.post("/cart/enquire")
 async def cart_enquiry(enquiry: CartEnquiry):
-    """Send cart enquiry to WhatsApp"""
+    """Send cart enquiry to WhatsApp (names and prices come from the catalog, not the client)"""
+    product_ids = list({item.product_id for item in enquiry.items})
+    products = await db.products.find(
+        {"id": {"$in": product_ids}},
+        {"_id": 0, "id": 1, "name": 1, "price": 1, "short_description": 1, "sizes": 1, "primary_color": 1, "available_colors": 1}
+    ).to_list(len(product_ids))
+    products_by_id = {p["id"]: p for p in products}
+    
+    items = [item for item in enquiry.items if item.product_id in products_by_id]
+    unavailable = sorted({item.product_id for item in enquiry.items} - products_by_id.keys())
+    if not items:
+        raise HTTPException(status_code=404, detail="None of the enquired products are available")
+    
+    # Sizes and colors must be ones the product offers; stored in the catalog's spelling
+    for item in items:
+        product = products_by_id[item.product_id]
+        item.size = catalog_option(item.size, product.get("sizes") or [], "Size", product)
+        colors = [product.get("primary_color")] + (product.get("available_colors") or [])
+        item.color = catalog_option(item.color, [c for c in colors if c], "Color", product)
+    
     try:
         phone_number = "918072153196"
         
         # Format message with product details
-        message_parts = ["*PRODUCT ENQUIRY*%0A%0A"]
-        
-        for idx, item in enumerate(enquiry.items, 1):
-            message_parts.append(f"*Product {idx}:*%0A")
-            message_parts.append(f"Name: {item.get('name', 'N/A')}%0A")
-            message_parts.append(f"Price: ₹{item.get('price', 0)}%0A")
-            message_parts.append(f"Size: {item.get('selectedSize', 'N/A')}%0A")
-            message_parts.append(f"Color: {item.get('selectedColor', 'N/A')}%0A")
-            if item.get('short_description'):
-                message_parts.append(f"Description: {item.get('short_description')}%0A")
-            message_parts.append("%0A")
+        message_parts = ["*PRODUCT ENQUIRY*\n\n"]
+        
+        for idx, item in enumerate(items, 1):
+            product = products_by_id[item.product_id]
+            message_parts.append(f"*Product {idx}:*\n")
+            message_parts.append(f"Name: {product.get('name', 'N/A')}\n")
+            message_parts.append(f"Price: ₹{product.get('price', 0)}\n")
+            message_parts.append(f"Size: {item.size or 'N/A'}\n")
+            message_parts.append(f"Color: {item.color or 'N/A'}\n")
+            if item.quantity > 1:
+                message_parts.append(f"Quantity: {item.quantity}\n")
+            if product.get('short_description'):
+                message_parts.append(f"Description: {product.get('short_description')}\n")
+            message_parts.append("\n")
         
         message_parts.append("Please confirm availability and provide purchase details.")
         
         message = "".join(message_parts)
-        whatsapp_url = f"https://wa.me/{phone_number}?text={message}"
+        whatsapp_url = f"https://wa.me/{phone_number}?text={quote(message)}"
         
-        # Store enquiry in database
+        # Store compact references, with the price at enquiry time
         enquiry_doc = {
             "id": str(uuid.uuid4()),
-            "items": enquiry.items,
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "items": [
+                {**item.model_dump(), "price": products_by_id[item.product_id].get("price", 0)}
+                for item in items
+            ],
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            **new_rollup_claim()
         }
         await db.enquiries.insert_one(enquiry_doc)
+        rollup_items = [{**item, "name": products_by_id[item["product_id"]].get("name")} for item in enquiry_doc["items"]]
+        await roll_up_inserted(db.enquiries, enquiry_doc, apply_enquiry_rollups, {**enquiry_doc, "items": rollup_items})
         
         return {
             "message": "Enquiry prepared successfully",
-            "whatsapp_url": whatsapp_url
+            "whatsapp_url": whatsapp_url,
+            "unavailable_product_ids": unavailable
         }
     except Exception as e:
         logging.error(f"Cart enquiry error: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to process enquiry")
 
+# ==================== ANALYTICS ROUTES ====================
+
+@api_router.get("/owner/analytics/enquiries")
+async def get_enquiry_analytics(days: int = 30, limit: int = 10, username: str = Depends(verify_token)):
+    """Most-enquired products, sizes and colors plus daily totals, read from rollups (Owner only)"""
+    days = max(1, min(days, 366))
+    since = (datetime.now(timezone.utc) - timedelta(days=days - 1)).date().isoformat()
+    
+    rollups = await db.enquiry_rollups.find({"day": {"$gte": since}}, {"_id": 0}).to_list(None)
+    daily = await db.daily_rollups.find({"_id": {"$gte": since}}).sort("_id", 1).to_list(None)
+    
+    product_counts = Counter()
+    product_names = {}
+    size_counts = Counter()
+    color_counts = Counter()
+    for rollup in rollups:
+        product_counts[rollup["product_id"]] += rollup["count"]
+        size_counts[rollup["size"]] += rollup["count"]
+        color_counts[rollup["color"]] += rollup["count"]
+        if rollup.get("product_name"):
+            product_names[rollup["product_id"]] = rollup["product_name"]
+    
+    return {
+        "since": since,
+        "days": days,
+        "totals": {
+            "enquiries": sum(d.get("enquiries", 0) for d in daily),
+            "enquiry_items": sum(d.get("enquiry_items", 0) for d in daily),
+            "feedbacks": sum(d.get("feedbacks", 0) for d in daily)
+        },
+        "daily": [
+            {
+                "day": d["_id"],
+                "enquiries": d.get("enquiries", 0),
+                "enquiry_items": d.get("enquiry_items", 0),
+                "feedbacks": d.get("feedbacks", 0)
+            }
+            for d in daily
+        ],
+        "top_products": [
+            {"product_id": product_id, "name": product_names.get(product_id, "N/A"), "count": count}
+            for product_id, count in product_counts.most_common(limit)
+        ],
+        "top_sizes": [{"size": size, "count": count} for size, count in size_counts.most_common(limit)],
+        "top_colors": [{"color": color, "count": count} for color, count in color_counts.most_common(limit)]
+    }
+
+@api_router.post("/owner/analytics/backfill")
+async def start_analytics_backfill(username: str = Depends(verify_token)):
+    """Roll up existing enquiries and feedbacks in the background (Owner only)"""
+    global analytics_backfill_task
+    if analytics_backfill_task is not None and not analytics_backfill_task.done():
+        return {"message": "Backfill already running"}
+    analytics_backfill_task = spawn_background(backfill_analytics_rollups())
+    return {"message": "Backfill started"}
+
+@api_router.get("/owner/slow-queries")
+async def get_slow_queries(limit: int = 20, username: str = Depends(verify_token)):
+    """Slowest query shapes by total time, with captured explain plans (Owner only)"""
+    return {"threshold_ms": SLOW_QUERY_MS, "queries": query_profiler.top(limit)}
+
+# ==================== HOMEPAGE ROUTES ====================
+
+@api_router.get("/home", response_model=HomeSnapshot)
+async def get_home():
+    """Get all homepage sections (fresh arrivals, new arrivals by category, reviews) in one response"""
+    body = await home_snapshot.get()
+    if body is None:
+        raise HTTPException(status_code=503, detail="Homepage is not available yet, please retry")
+    return Response(content=body, media_type="application/json")
+
 # ==================== METADATA ROUTES ====================
 
 @api_router.post("/generate-description")
@@ -739,6 +2212,8 @@ async def generate_description(
 ):
     """Generate detailed product description using AI"""
     try:
+        from emergentintegrations.llm.chat import LlmChat, UserMessage
+        
         chat = LlmChat(
             api_key=EMERGENT_LLM_KEY,
             session_id=f"desc-generation-{uuid.uuid4()}",
@@ -832,12 +2307,258 @@ async def get_all_fabrics():
     all_fabrics = FABRIC_OPTIONS + custom_fabric_names
     return {"fabrics": sorted(list(set(all_fabrics)))}
 
+# ==================== RESPONSE COMPRESSION ====================
+
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_THREAD_SIZE = 64 * 1024  # compress larger bodies off the event loop
+COMPRESSION_CACHE_MAX_BYTES = 64 * 1024 * 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# Cached payloads are compressed once, so they can afford the slower, smaller settings
+GZIP_CACHED_LEVEL = 9
+BROTLI_CACHED_QUALITY = 9
+INCOMPRESSIBLE_CONTENT_TYPES = ("image/", "video/", "audio/", "application/zip", "application/gzip", "font/woff")
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """Pick br or gzip from an Accept-Encoding header, honoring q=0"""
+    qualities = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        qualities[name.strip().lower()] = q
+    
+    wildcard = qualities.get('*', 0.0)
+    if brotli is not None and qualities.get('br', wildcard) > 0:
+        return 'br'
+    if qualities.get('gzip', wildcard) > 0:
+        return 'gzip'
+    return None
+
+def compress_body(body: bytes, encoding: str, cached: bool) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_CACHED_QUALITY if cached else BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_CACHED_LEVEL if cached else GZIP_LEVEL, mtime=0)
+
+class CompressedBodyCache:
+    """LRU of compressed bodies keyed by (encoding, digest of the uncompressed body)"""
+    
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: OrderedDict = OrderedDict()
+    
+    def get(self, key: tuple) -> Optional[bytes]:
+        body = self.entries.get(key)
+        if body is not None:
+            self.entries.move_to_end(key)
+        return body
+    
+    def put(self, key: tuple, body: bytes):
+        if len(body) > self.max_bytes or key in self.entries:
+            return
+        self.entries[key] = body
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+compressed_body_cache = CompressedBodyCache(COMPRESSION_CACHE_MAX_BYTES)
+
+class CompressionMiddleware:
+    """Brotli/gzip response compression; public GET responses reuse cached compressed bytes"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        request_headers = Headers(scope=scope)
+        encoding = negotiate_encoding(request_headers.get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        
+        # Owner responses are per-user, keep them out of the shared cache
+        cacheable = scope["method"] == "GET" and "authorization" not in request_headers
+        start_message = None
+        passthrough = False
+        body_parts = []
+        
+        async def send_compressed(message):
+            nonlocal start_message, passthrough
+            if passthrough:
+                await send(message)
+                return
+            
+            if message["type"] == "http.response.start":
+                response_headers = Headers(raw=message["headers"])
+                content_type = response_headers.get("content-type", "")
+                if "content-encoding" in response_headers or content_type.startswith(INCOMPRESSIBLE_CONTENT_TYPES):
+                    passthrough = True
+                    await send(message)
+                else:
+                    start_message = message
+                return
+            
+            body_parts.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            
+            body = b"".join(body_parts)
+            if len(body) < COMPRESSION_MIN_SIZE:
+                await send(start_message)
+                await send({"type": "http.response.body", "body": body})
+                return
+            
+            use_cache = cacheable and start_message["status"] == 200
+            compressed = None
+            if use_cache:
+                cache_key = (encoding, hashlib.blake2b(body, digest_size=16).digest())
+                compressed = compressed_body_cache.get(cache_key)
+            if compressed is None:
+                if len(body) >= COMPRESSION_THREAD_SIZE:
+                    compressed = await asyncio.to_thread(compress_body, body, encoding, use_cache)
+                else:
+                    compressed = compress_body(body, encoding, use_cache)
+                if use_cache:
+                    compressed_body_cache.put(cache_key, compressed)
+            
+            headers = MutableHeaders(raw=list(start_message["headers"]))
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(compressed))
+            headers.add_vary_header("Accept-Encoding")
+            await send({**start_message, "headers": headers.raw})
+            await send({"type": "http.response.body", "body": compressed})
+        
+        await self.app(scope, receive, send_compressed)
+
+# ==================== STARTUP LIFECYCLE ====================
+
+lifecycle = {"import_ms": None, "boot_ms": None, "boot_started": None, "ready": False}
+
+async def wait_for_mongodb():
+    """Ping MongoDB until it answers, backing off between attempts"""
+    delay = 0.5
+    while True:
+        try:
+            await client.admin.command("ping")
+            return
+        except Exception as e:
+            logging.warning(f"MongoDB not reachable yet: {str(e)}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 10)
+
+def warm_validators():
+    """Run the hot response models once so the first real request skips lazy setup"""
+    sample = Product(name="warmup", category="men", subcategory="warmup", fabric="Cotton", primary_color="Red")
+    TypeAdapter(List[Product]).dump_json([sample])
+    HomeSnapshot(
+        fresh_arrivals=[sample], fresh_arrivals_count=1, new_arrivals={"men": [sample]},
+        reviews=[Review(name="warmup", rating=5, date="", review="", location="")],
+        generated_at=datetime.now(timezone.utc)
+    ).model_dump_json()
+
+# (collection, keys, options) created on every boot; create_index is a no-op when present
+STARTUP_INDEXES = [
+    ("product_features", "product_id", {"unique": True}),
+    ("product_features", "updated_at", {}),
+    ("images", "id", {"unique": True}),
+    ("images", "sha256", {"unique": True}),
+    ("enquiry_rollups", "day", {}),
+    # Backfill claims: rolled_up lets each batch skip counted history, the sparse
+    # rollup_claim index only holds documents that are currently claimed
+    ("enquiries", "rolled_up", {}),
+    ("enquiries", "rollup_claim", {"sparse": True}),
+    ("feedbacks", "rolled_up", {}),
+    ("feedbacks", "rollup_claim", {"sparse": True}),
+]
+
+async def ensure_indexes():
+    for collection_name, keys, options in STARTUP_INDEXES:
+        try:
+            await db[collection_name].create_index(keys, **options)
+        except Exception as e:
+            logging.error(f"Index creation error on {collection_name}: {str(e)}")
+
+async def warm_up():
+    """Verify MongoDB, warm caches, then mark the worker ready"""
+    await wait_for_mongodb()
+    await ensure_indexes()
+    
+    await home_snapshot.refresh()
+    
+    warm_validators()
+    
+    lifecycle["boot_ms"] = (time.perf_counter() - lifecycle["boot_started"]) * 1000
+    lifecycle["ready"] = True
+    logging.info(f"Ready: import {lifecycle['import_ms']:.0f} ms, boot {lifecycle['boot_ms']:.0f} ms")
+    
+    # Image migration and index builds can take a while on large catalogs and are not needed to serve traffic
+    spawn_background(migrate_inline_images())
+    spawn_background(load_similarity_index())
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client
+    lifecycle["boot_started"] = time.perf_counter()
+    client = AsyncIOMotorClient(mongo_url, serverSelectionTimeoutMS=5000)
+    db.bind(client[os.environ['DB_NAME']])
+    spawn_background(warm_up())
+    yield
+    # Stop warmup, index loads and pending rebuilds before the client goes away
+    pending = list(background_tasks)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    client.close()
+
+# ==================== HEALTH ROUTES ====================
+
+@api_router.get("/healthz")
+async def healthz():
+    """Liveness probe: the process is up"""
+    return {"status": "ok", "import_ms": lifecycle["import_ms"], "boot_ms": lifecycle["boot_ms"]}
+
+@api_router.get("/readyz")
+async def readyz():
+    """Readiness probe: warmup finished and MongoDB answers a ping"""
+    checks = {"warmup": lifecycle["ready"], "mongodb": False}
+    if client is not None:
+        try:
+            await asyncio.wait_for(client.admin.command("ping"), timeout=2)
+            checks["mongodb"] = True
+        except Exception as e:
+            logging.warning(f"Readiness ping failed: {str(e)}")
+    
+    ready = all(checks.values())
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "status": "ready" if ready else "starting",
+            "checks": checks,
+            "import_ms": lifecycle["import_ms"],
+            "boot_ms": lifecycle["boot_ms"]
+        }
+    )
+
 # ==================== ROOT ROUTE ====================
 
 @api_router.get("/")
 async def root():
     return {"message": "Milan Readymades API", "version": "2.0"}
 
+# Create the main app
+app = FastAPI(lifespan=lifespan)
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -850,6 +2571,24 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def apply_query_budget(request: Request, call_next):
+    budget_token = query_budget_ms.set(route_query_budget(request.url.path))
+    route_token = query_route.set(f"{request.method} {request.url.path}")
+    try:
+        return await call_next(request)
+    finally:
+        query_budget_ms.reset(budget_token)
+        query_route.reset(route_token)
+
+@app.exception_handler(ExecutionTimeout)
+async def query_timeout_handler(request: Request, exc: ExecutionTimeout):
+    logging.error(f"Query time budget exceeded on {request.method} {request.url.path}")
+    return JSONResponse(status_code=503, content={"detail": "Request took too long, please retry"})
+
+# Added last so it wraps every other middleware
+app.add_middleware(CompressionMiddleware)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -857,6 +2596,4 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
+lifecycle["import_ms"] = (time.perf_counter() - IMPORT_STARTED) * 1000
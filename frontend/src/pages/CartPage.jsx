@@ -40,7 +40,14 @@ export const CartPage = () => {
     setLoading(true);
 
     try {
-      const itemsToEnquire = cart.filter(item => selectedItems.includes(item.cartId));
+      const itemsToEnquire = cart
+        .filter(item => selectedItems.includes(item.cartId))
+        .map(item => ({
+          product_id: item.id,
+          size: item.selectedSize,
+          color: item.selectedColor,
+          quantity: item.quantity || 1
+        }));
       const response = await axios.post(`${API}/cart/enquire`, { items: itemsToEnquire });
       
       window.open(response.data.whatsapp_url, '_blank');
@@ -49,10 +56,23 @@ export const CartPage = () => {
         title: 'Enquiry sent!',
         description: 'Opening WhatsApp...'
       });
+
+      const unavailableIds = response.data.unavailable_product_ids || [];
+      if (unavailableIds.length > 0) {
+        const unavailableNames = cart
+          .filter(item => unavailableIds.includes(item.id))
+          .map(item => item.name);
+        toast({
+          title: 'Some items are no longer available',
+          description: `Left out of the enquiry: ${[...new Set(unavailableNames)].join(', ') || unavailableIds.join(', ')}`,
+          variant: 'destructive'
+        });
+      }
     } catch (error) {
+      const detail = error.response?.data?.detail;
       toast({
         title: 'Error',
-        description: 'Failed to process enquiry',
+        description: typeof detail === 'string' ? detail : 'Failed to process enquiry',
         variant: 'destructive'
       });
     } finally {
@@ -22,8 +22,8 @@ export const HomePage = () => {
   const loadFreshArrivals = async () => {
     try {
       setLoading(true);
-      const response = await axios.get(`${API}/products?show_in_fresh_arrivals=true`);
-      setFreshArrivals(response.data.slice(0, 8)); // Show first 8 items
+      const response = await axios.get(`${API}/home`);
+      setFreshArrivals(response.data.fresh_arrivals); // Snapshot holds the latest 8 items
     } catch (error) {
       console.error('Error loading fresh arrivals:', error);
     } finally {